@@ -1,10 +1,11 @@
-from abc import abstractclassmethod, abstractmethod
-import requests
+from abc import abstractmethod
+import httpx
 import pandas as pd
 
-from io import StringIO
+from functools import cached_property
+from io import BytesIO, StringIO
 import datetime
-from typing import Tuple, Set, Dict, Any
+from typing import Tuple, Set, Dict, Any, Optional
 
 from abc import ABC
 
@@ -14,27 +15,48 @@ import re
 
 API_URL = "https://intervals.icu"
 
+_API_KEY_RE = re.compile(r'\w{24}')
+_ATHLETE_ID_RE = re.compile(r'i\d+')
+
+
+def create_client() -> httpx.Client:
+    """Create a client that keeps an HTTP/2 connection to Intervals.icu alive.
+
+    HTTP/2 support requires the h2 package (``pip install httpx[http2]``).
+    """
+    return httpx.Client(
+        base_url=API_URL,
+        http2=True,
+        limits=httpx.Limits(max_keepalive_connections=10, keepalive_expiry=30),
+    )
+
 
 class Endpoint(ABC):
-    @abstractmethod
     @property
+    @abstractmethod
     def endpoint_url_format(self) -> str:
         pass
 
     def url(self, url_format="", **kwargs) -> str:
-        return (API_URL + self.endpoint_url_format + url_format).format(athlete_id=self.athlete_id, **kwargs)
+        """Path of the request, relative to the API_URL the client is bound to."""
+        return (self.endpoint_url_format + url_format).format(athlete_id=self.athlete_id, **kwargs)
 
     auth: Tuple[str, str]
     athlete_id: str
+    client: httpx.Client
 
-    def __init__(self, athlete_id, api_key):
-        """Initialize endpoint."""
+    def __init__(self, athlete_id, api_key, client: Optional[httpx.Client] = None):
+        """Initialize endpoint.
+
+        Pass a client to share its connection with other endpoints.
+        """
         self.auth = ("API_KEY", api_key)
         self.athlete_id = athlete_id
+        self.client = client if client is not None else create_client()
 
     def get_request(self, url_format="", query_parameters=None) -> Dict[Any, Any]:
         """Perform JSON requests on a certain endpoint."""
-        r = requests.get(
+        r = self.client.get(
             self.url(url_format),
             auth=self.auth,
             params=query_parameters,
@@ -45,8 +67,7 @@ class Endpoint(ABC):
 
     def get_content_request(self, url_format, query_parameters=None):
         """Perform requests on a certain endpoint as text."""
-        complete_url_format = self.endpoint_url_format + url_format
-        r = requests.get(
+        r = self.client.get(
             self.url(url_format),
             auth=self.auth,
             params=query_parameters,
@@ -57,7 +78,7 @@ class Endpoint(ABC):
 
     def put_request(self, url_format, data, query_parameters=None):
         """Perform a put request on a certain endpoint."""
-        r = requests.put(
+        r = self.client.put(
             self.url(url_format),
             auth=self.auth,
             params=query_parameters,
@@ -68,8 +89,8 @@ class Endpoint(ABC):
         return r.json()
 
     def delete_request(self, url_format, query_parameters=None):
-        """Perform a put request on a certain endpoint."""
-        r = requests.put(
+        """Perform a delete request on a certain endpoint."""
+        r = self.client.delete(
             self.url(url_format),
             auth=self.auth,
             params=query_parameters
@@ -80,9 +101,9 @@ class Endpoint(ABC):
 
 
 class CSVEndpoint(Endpoint):
-    def get_request_csv(self, url_format, query_parameters=None) -> pd.DataFrame:
-        r = requests.get(
-            self.url(url_format + ".csv"),
+    def get_request_csv(self, url_format="", query_parameters=None, **kwargs) -> pd.DataFrame:
+        r = self.client.get(
+            self.url(url_format + ".csv", **kwargs),
             auth=self.auth,
             params=query_parameters,
         )
@@ -93,11 +114,15 @@ class CSVEndpoint(Endpoint):
         response_file = StringIO(response_content)
         return pd.read_csv(response_file)
 
-    def post_request_csv(self, url_format, data: pd.DataFrame, index_label):
-        csv = data.to_csv(index_label=index_label)
+    def post_request_csv(self, url_format, data: pd.DataFrame, index_label, **kwargs):
+        # Write the CSV as bytes straight into a buffer the request body is
+        # streamed from, instead of rendering a string that is copied again.
+        csv = BytesIO()
+        data.to_csv(csv, index_label=index_label, mode='wb')
+        csv.seek(0)
 
-        r = requests.post(
-            self.url(url_format),
+        r = self.client.post(
+            self.url(url_format, **kwargs),
             auth=self.auth,
             files={
                 'file': ('wellness.csv', csv)
@@ -106,6 +131,9 @@ class CSVEndpoint(Endpoint):
 
         logging.debug(f"Sending POST request to {r.url}")
 
+        # Callers rely on a returned upload having been accepted
+        r.raise_for_status()
+
         return r.text
 
 
@@ -188,8 +216,8 @@ class WellnessCSVEndpoint(CSVEndpoint):
 
     endpoint_url_format = "/api/v1/athlete/{athlete_id}/wellness"
 
-    def __init__(self, athlete, auth_key):
-        super().__init__(athlete, auth_key)
+    def __init__(self, athlete, auth_key, client: Optional[httpx.Client] = None):
+        super().__init__(athlete, auth_key, client)
 
     def get(
         self,
@@ -212,55 +240,63 @@ class WellnessCSVEndpoint(CSVEndpoint):
             params["cols"] = ",".join(cols)
 
         return self.get_request_csv(
-            # self.endpoint_url.format(**kwargs, athlete_id=self.athlete_id),
-            self.url(**kwargs),
             query_parameters=params,
+            **kwargs
         )
 
     def update(self, data: pd.DataFrame, index_label, **kwargs):
         """Update multiple wellness entries"""
         return self.post_request_csv(
-            # self.endpoint_url.format(**kwargs, athlete_id=self.athlete_id),
-            self.url(**kwargs),
+            "",
             data=data,
-            index_label=index_label
+            index_label=index_label,
+            **kwargs
         )
 
 
 class API:
     """A wrapper for all the Endpoints in the API."""
 
-    def __init__(self, athlete_id, api_key):
+    def __init__(self, athlete_id, api_key, client: Optional[httpx.Client] = None):
+        """Initialize the API for an athlete.
+
+        Pass a client to share its connection with the APIs of other athletes.
+        """
         assert self.validate_athlete_id(athlete_id)
         assert self.validate_api_key(api_key)
 
         self.athlete_id = athlete_id
         self.api_key = api_key
 
-    @property
+        # All endpoints share one client, so consecutive requests are
+        # multiplexed over the same HTTP/2 connection instead of doing a new
+        # TCP and TLS handshake.
+        self.client = client if client is not None else create_client()
+
+    @cached_property
     def events(self) -> EventsEndpoint:
-        return EventsEndpoint(self.athlete_id, self.api_key)
+        return EventsEndpoint(self.athlete_id, self.api_key, self.client)
 
-    @property
+    @cached_property
     def wellness(self) -> WellnessEndpoint:
-        return WellnessEndpoint(self.athlete_id, self.api_key)
+        return WellnessEndpoint(self.athlete_id, self.api_key, self.client)
 
-    @property
+    @cached_property
     def calendar(self) -> CalendarEndpoint:
-        return CalendarEndpoint(self.athlete_id, self.api_key)
+        return CalendarEndpoint(self.athlete_id, self.api_key, self.client)
 
-    @property
+    @cached_property
     def wellness_csv(self) -> WellnessCSVEndpoint:
-        return WellnessCSVEndpoint(self.athlete_id, self.api_key)
+        return WellnessCSVEndpoint(self.athlete_id, self.api_key, self.client)
 
-    @property
+    @cached_property
     def activities_csv(self) -> ActivitiesCSVEndpoint:
-        return ActivitiesCSVEndpoint(self.athlete_id, self.api_key)
+        return ActivitiesCSVEndpoint(self.athlete_id, self.api_key, self.client)
 
     @staticmethod
     def validate_api_key(api_key: str) -> bool:
-        return bool(re.match(r'\w{24}', api_key))
+        return bool(_API_KEY_RE.match(api_key))
 
     @staticmethod
     def validate_athlete_id(athlete_id: str) -> bool:
-        return bool(re.match(r'i\d+', athlete_id))
\ No newline at end of file
+        return bool(_ATHLETE_ID_RE.match(athlete_id))
\ No newline at end of file
@@ -1,27 +1,37 @@
 #!/usr/bin/env python
-from intervals_api import API
+from intervals_api import API, create_client
 
 from dropbox import DropboxOAuth2FlowNoRedirect, Dropbox
+from dropbox.files import FileMetadata
+import httpx
 
-from configparser import ConfigParser
+from configparser import ConfigParser, SectionProxy
 import argparse
+import csv
 import logging
 
 import json
+from io import BytesIO
 
 import sys
 import os
+import time
 
 import pandas as pd
 import numpy as np
 
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pacsv
+except ImportError:
+    pa = None
+    pacsv = None
+
+from concurrent.futures import ThreadPoolExecutor
 from functools import partial
 from itertools import product
 
-from typing import Set
-import hashlib
-
-import pathlib
+from typing import Any, BinaryIO, Dict, Iterator, Tuple
 
 from abc import ABC
 from dataclasses import dataclass
@@ -45,6 +55,41 @@ REMOTE_HRV_FILE_PATH = "/Apps/HRV4TRAINING/MyMeasurements_Android.csv"
 
 DROPBOX_TOKEN_PATH_FORMAT = os.path.join(STORAGE_DIR, "dropbox-tokens-{user}.csv")
 
+DOWNLOAD_CHUNK_SIZE = 1 << 20
+
+# Users synced at the same time, the work is mostly waiting on Dropbox and Intervals.icu
+MAX_SYNC_WORKERS = 8
+
+SYNC_STATE_PATH = os.path.join(CACHE_DIR, "sync_state.json")
+# Seconds after a successful check in which Dropbox is not asked for changes again
+SYNC_STATE_TTL = 15 * 60
+
+# Columns of the HRV4Training CSV that are used to build the Intervals.icu data
+HRV4TRAINING_COLUMNS = {
+    'date', 'time',
+    'rMSSD', 'SDNN', 'muscle_soreness', 'fatigue', 'stress', 'mood', 'trainingMotivation', 'sleep_quality',
+    *(f'custom_tag_{i}_{field}' for i in range(1, 4) for field in ('name', 'value')),
+}
+# Questions that can also be answered through a custom tag, whose lowercased
+# name then takes the place of the column. Every other column is required.
+HRV4TRAINING_TAG_QUESTION_COLUMNS = {'muscle_soreness', 'fatigue', 'stress', 'mood', 'sleep_quality'}
+HRV4TRAINING_REQUIRED_COLUMNS = HRV4TRAINING_COLUMNS - HRV4TRAINING_TAG_QUESTION_COLUMNS
+HRV4TRAINING_TEXT_COLUMNS = {
+    'date', 'time',
+    *(f'custom_tag_{i}_{field}' for i in range(1, 4) for field in ('name', 'value')),
+}
+# The questionnaire answers, read as float32 so they are always numeric and
+# take half the memory. They are mapped to the Intervals.icu scale anyway,
+# unlike the HRV measurements, which are uploaded as read.
+HRV4TRAINING_FLOAT32_COLUMNS = {
+    'muscle_soreness', 'fatigue', 'stress', 'mood', 'trainingMotivation', 'sleep_quality',
+}
+
+# Size of the chunks the HRV4Training CSV is read in, in rows for pandas and
+# in bytes for pyarrow
+CSV_CHUNK_ROWS = 50_000
+CSV_BLOCK_SIZE = 1 << 22
+
 
 def main():
     parser = argparse.ArgumentParser()
@@ -123,6 +168,7 @@ class SyncCommand(Command):
 
         ensure_directory(CONFIG_DIR)
         ensure_directory(STORAGE_DIR)
+        ensure_directory(CACHE_DIR)
 
         user_config = parse_config(USER_CONFIG_FILE_PATH)
 
@@ -132,41 +178,181 @@ class SyncCommand(Command):
             print("No users found. Check --help how to add an account.")
             sys.exit(1)
 
+        # Getting a Dropbox instance might ask for an authorization code, so
+        # this is done one user at a time before syncing them concurrently.
+        dropbox_instances = {}
         for user in users:
-            user_info = user_config[user]
-            athlete_id = user_info[USER_CONFIG_ATHLETE_ID_FIELD]
-            api_key = user_info[USER_CONFIG_API_KEY_FIELD]
-
             try:
-                download_path = LOCAL_HRV_FILE_PATH_FORMAT.format(user=user)
-
-                dbx = get_dropbox_instance(user, config['Dropbox']['app_key'], config['Dropbox']['app_secret'])
-                old_hash = get_md5sum(download_path) if os.path.exists(download_path) else None
-
-                result = dbx.files_download_to_file(download_path, REMOTE_HRV_FILE_PATH)
-                new_hash = get_md5sum(download_path)
-
-                if old_hash == new_hash:
-                    logging.info(f"HRV4Training CSV did not change for user: {user}, skipping")
-                    return
-                else:
-                    logging.info("Found new data from HRV4Training")
-                    logging.debug(f"Old hash: {old_hash}; new hash: {new_hash}")
-
-                HRV4Training_data = pd.read_csv(download_path, index_col=False)
+                dropbox_instances[user] = get_dropbox_instance(
+                    user, config['Dropbox']['app_key'], config['Dropbox']['app_secret']
+                )
+            except Exception as e:
+                logging.warning(f"Could not connect to Dropbox for user: {user}, skipping")
+                logging.warning(e)
 
-                intervals_data = parse_dataframe_HRV_to_intervals(HRV4Training_data)
+        # Loaded and stored once, every concurrent sync only updates its own user
+        sync_state = get_sync_state()
+
+        # All users are uploaded to the same host, so they share one client and
+        # thereby one HTTP/2 connection to Intervals.icu.
+        try:
+            with create_client() as client:
+                self.sync_all(user_config, dropbox_instances, client, sync_state)
+        finally:
+            # Keep the state of users that did sync, even if another one failed
+            store_sync_state(sync_state)
+
+    def sync_all(
+        self,
+        user_config: ConfigParser,
+        dropbox_instances: Dict[str, Dropbox],
+        client: httpx.Client,
+        sync_state: Dict[str, Dict[str, Any]]
+    ):
+        """Sync all users concurrently, the work per user is mostly waiting on network I/O."""
+        if len(dropbox_instances) == 0:
+            return
+
+        users = list(dropbox_instances)
+        sync_user = partial(self.sync, client=client, sync_state=sync_state)
+
+        # Collect the results, so errors outside of the per user error
+        # handling, like an incomplete user config, are still raised.
+        with ThreadPoolExecutor(max_workers=min(MAX_SYNC_WORKERS, len(users))) as executor:
+            list(executor.map(
+                sync_user,
+                users,
+                [user_config[user] for user in users],
+                [dropbox_instances[user] for user in users],
+            ))
+
+    def sync(
+        self,
+        user: str,
+        user_info: SectionProxy,
+        dbx: Dropbox,
+        client: httpx.Client,
+        sync_state: Dict[str, Dict[str, Any]]
+    ):
+        """Sync HRV4Training data of a single user to Intervals.icu."""
+        athlete_id = user_info[USER_CONFIG_ATHLETE_ID_FIELD]
+        api_key = user_info[USER_CONFIG_API_KEY_FIELD]
+
+        try:
+            download_path = LOCAL_HRV_FILE_PATH_FORMAT.format(user=user)
+
+            user_state = sync_state.get(user, {})
+
+            if time.time() - user_state.get("ts", 0) < SYNC_STATE_TTL:
+                logging.info(f"HRV4Training CSV was checked recently for user: {user}, skipping")
+                return
+
+            # Dropbox keeps a hash of the file contents, comparing it to the last
+            # synced one avoids downloading a file that did not change.
+            old_hash = user_state.get("hash")
+            new_hash = dbx.files_get_metadata(REMOTE_HRV_FILE_PATH).content_hash
+
+            if old_hash == new_hash:
+                logging.info(f"HRV4Training CSV did not change for user: {user}, skipping")
+                sync_state[user] = {**user_state, "ts": time.time()}
+                return
+            else:
+                logging.info("Found new data from HRV4Training")
+                logging.debug(f"Old hash: {old_hash}; new hash: {new_hash}")
+
+            # The CSV is parsed straight from memory, the local copy is only
+            # written for reference and never read back.
+            metadata, HRV4Training_csv = download_to_buffer(dbx, REMOTE_HRV_FILE_PATH)
+            with open(download_path, "wb") as f:
+                f.write(HRV4Training_csv.getbuffer())
+
+            # Rows are converted independently of each other, so the file can be
+            # parsed in chunks. Columns that only come from custom tags are
+            # filled in for chunks without them, see parse_dataframe_HRV_to_intervals.
+            intervals_data = pd.concat(
+                parse_dataframe_HRV_to_intervals(HRV4Training_data)
+                for HRV4Training_data in read_HRV4Training_csv(HRV4Training_csv)
+            )
 
-                logging.info(f"Uploading {len(intervals_data)} entries to Intervals.icu for user: {user}")
+            logging.info(f"Uploading {len(intervals_data)} entries to Intervals.icu for user: {user}")
+
+            # Raises when Intervals.icu does not accept the upload
+            API(athlete_id, api_key, client).wellness_csv.update(intervals_data, index_label="date")
+
+            # Only remember the file once the data made it to Intervals.icu
+            sync_state[user] = {
+                "rev": metadata.rev,
+                "hash": metadata.content_hash,
+                "ts": time.time(),
+            }
+        except Exception as e:
+            logging.warning(f"Something went wrong for user: {user}, skipping")
+            logging.warning(e)
+        except:
+            logging.warning(f"Something went wrong for user: {user}, skipping")
+
+
+def read_HRV4Training_csv(csv_file: BinaryIO) -> Iterator[pd.DataFrame]:
+    """Read the HRV4Training CSV in chunks, skipping all columns that are not used.
+
+    The multithreaded pyarrow CSV parser is used when pyarrow is installed.
+    """
+    # Column names are padded with spaces, see parse_dataframe_HRV_to_intervals.
+    # Both parsers select and type columns by their exact, padded, name.
+    # A byte order mark is not part of the first name, both parsers skip it.
+    header = next(csv.reader([csv_file.readline().decode("utf-8-sig")]))
+    csv_file.seek(0)
+
+    missing_columns = HRV4TRAINING_REQUIRED_COLUMNS - {column.strip() for column in header}
+    if missing_columns:
+        raise ValueError(f"HRV4Training CSV is missing columns: {', '.join(sorted(missing_columns))}")
+
+    columns = [column for column in header if column.strip() in HRV4TRAINING_COLUMNS]
+
+    if pacsv is None:
+        yield from pd.read_csv(
+            csv_file,
+            index_col=False,
+            usecols=columns,
+            dtype={
+                column: "float32"
+                for column in columns
+                if column.strip() in HRV4TRAINING_FLOAT32_COLUMNS
+            },
+            chunksize=CSV_CHUNK_ROWS,
+        )
+        return
+
+    # The streaming reader infers types from the first block only, so a custom
+    # tag that is not used at the start of the file would break later blocks.
+    # Tag values are kept as text, they are not necessarily numbers.
+    column_types = {
+        column: (
+            pa.string() if column.strip() in HRV4TRAINING_TEXT_COLUMNS else
+            pa.float32() if column.strip() in HRV4TRAINING_FLOAT32_COLUMNS else
+            pa.float64()
+        )
+        for column in columns
+    }
 
-                result = API(athlete_id, api_key).wellness_csv.update(intervals_data, index_label="date")
+    reader = pacsv.open_csv(
+        csv_file,
+        read_options=pacsv.ReadOptions(block_size=CSV_BLOCK_SIZE),
+        convert_options=pacsv.ConvertOptions(
+            include_columns=columns,
+            column_types=column_types,
+            # Match pandas, which reads empty fields as missing values
+            strings_can_be_null=True,
+        ),
+    )
+    batches = 0
+    for batch in reader:
+        batches += 1
+        yield batch.to_pandas()
 
-                assert 'status' not in result or result['status'] == 200
-            except Exception as e:
-                logging.warning(f"Something went wrong for user: {user}, skipping")
-                logging.warning(e)
-            except:
-                logging.warning(f"Something went wrong for user: {user}, skipping")
+    # A file with only a header has no batches, but is still a valid, empty, CSV
+    if batches == 0:
+        yield reader.schema.empty_table().to_pandas()
 
 
 def parse_dataframe_HRV_to_intervals(data: pd.DataFrame) -> pd.DataFrame:
@@ -199,32 +385,45 @@ def parse_dataframe_HRV_to_intervals(data: pd.DataFrame) -> pd.DataFrame:
     # Per entry we have a name of the question and coupled value.
     # We want to parse this so they are normal columns like all other questions
 
-    additional_columns: Set[str] = set()
-
-    # This seems needlessly complex, but this does account for when
-    # somebody changing the order of their additional columns.
-    for i in range(1, 4):
-        additional_columns = additional_columns | set(data[f'custom_tag_{i}_name'].dropna())
-
-    for column in additional_columns:
-        column_data = pd.Series(dtype=float)
+    # Stack the three name/value pairs into one long frame, keyed by row
+    # position as a date can occur more than once. This also accounts for
+    # when somebody changes the order of their additional columns.
+    tags = pd.concat([
+        pd.DataFrame({
+            'row': np.arange(len(data)),
+            'name': data[f'custom_tag_{i}_name'].to_numpy(),
+            'value': data[f'custom_tag_{i}_value'].to_numpy(),
+        })
+        for i in range(1, 4)
+    ]).dropna()
+
+    # Pivot back to one column per question, the first tag with a value wins.
+    # Tags are stacked in order, so dropping duplicates keeps the first one.
+    tags['name'] = tags['name'].astype(str).str.lower()
+    additional_columns = (
+        tags.drop_duplicates(['row', 'name'])
+        .pivot(index='row', columns='name', values='value')
+        .reindex(np.arange(len(data)))
+    )
 
-        for i in range(1, 4):
-            indices = data[f'custom_tag_{i}_name'] == column
-            column_data = column_data.combine_first(data[indices][f'custom_tag_{i}_value'].dropna())
+    if not additional_columns.empty:
+        data[list(additional_columns.columns)] = additional_columns.to_numpy()
 
-        data[column.lower()] = column_data
+    # A question can be answered through a custom tag only, which does not
+    # have to be used in every chunk of the file. Other columns are checked
+    # to be present when reading the file.
+    for old_name in HRV4TRAINING_TAG_QUESTION_COLUMNS - set(data.columns):
+        data[old_name] = np.nan
 
     # Build new dataframe with new column names and after all values are mapped to their new scale
-    new_data = pd.DataFrame()
-    for old_name, (new_name, map_func) in hrv_to_intervals_map.items():
-        new_data[new_name] = (
+    return pd.DataFrame({
+        new_name: (
             data[old_name]
             if map_func is None else
             map_func(data[old_name])
         )
-
-    return new_data
+        for old_name, (new_name, map_func) in hrv_to_intervals_map.items()
+    })
 
 
 def parse_config(config_location: str):
@@ -301,34 +500,64 @@ def store_tokens(user: str, oauth_result):
         )
 
 
-def get_md5sum(filepath: pathlib.Path):
-    with open(filepath, 'rb') as f:
-        return hashlib.md5(f.read()).hexdigest()
+def download_to_buffer(dbx: Dropbox, remote_path: str) -> Tuple[FileMetadata, BytesIO]:
+    """Download a file from Dropbox into memory."""
+    metadata, response = dbx.files_download(remote_path)
+
+    buffer = BytesIO()
+    with response:
+        for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+            buffer.write(chunk)
+
+    buffer.seek(0)
+    return metadata, buffer
+
+
+def get_sync_state() -> Dict[str, Dict[str, Any]]:
+    """Get the Dropbox revision, content hash and check time of the last sync per user."""
+    try:
+        with open(SYNC_STATE_PATH, "r") as f:
+            return json.loads(f.read())
+    except FileNotFoundError:
+        return {}
+
+
+def store_sync_state(sync_state: Dict[str, Dict[str, Any]]):
+    with open(SYNC_STATE_PATH, "w") as f:
+        f.write(json.dumps(sync_state))
 
 
 # Map functions
+# HRV4Training uses a 0-10 scale, Intervals.icu uses 1-4 for the same questions
+MAP_BINS = np.linspace(0, 10, 5)
+MAP_LABELS = np.arange(1, 5)
+MAP_LABELS_REVERSE = MAP_LABELS[::-1]
+
+
+def map_series_to_labels(series: pd.Series, labels: np.ndarray):
+    """Map values to the label of their bin, like pd.cut with right and include_lowest."""
+    values = series.to_numpy(dtype=float, na_value=np.nan)
+    bin_indices = np.digitize(values, MAP_BINS[1:-1], right=True)
+
+    # Missing values and values outside of the scale are left empty
+    in_range = (values >= MAP_BINS[0]) & (values <= MAP_BINS[-1])
+
+    mapped = pd.Series(pd.array(labels[bin_indices], dtype="Int8"), index=series.index)
+    return mapped.where(in_range)
+
+
 def map_series(series: pd.Series):
-    return pd.cut(
-        series,
-        np.linspace(0, 10, 5),
-        right=True,
-        include_lowest=True,
-        labels=range(1, 5)
-    )
+    return map_series_to_labels(series, MAP_LABELS)
 
 
 def map_series_reverse(series: pd.Series):
-    return pd.cut(
-        series,
-        np.linspace(0, 10, 5),
-        right=True,
-        include_lowest=True,
-        labels=range(4, 0, -1)
-    )
+    return map_series_to_labels(series, MAP_LABELS_REVERSE)
 
 
 def map_series_american_to_iso_date(series: pd.Series):
-    return series.map(lambda x: f"{x[0:4]}-{x[8:10]}-{x[5:7]}")
+    # Slice with the vectorized string accessor instead of a Python callback per row
+    date = series.str
+    return date[0:4] + "-" + date[8:10] + "-" + date[5:7]
 
 
 if __name__ == "__main__":